@@ -1,120 +1,526 @@
 from __future__ import annotations
+import asyncio
 import csv
 import io
+import logging
 import os
-import uuid
+import queue
+import secrets
+import sys
+from itertools import islice
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-from typing import List, Optional
+from typing import AsyncIterator, Awaitable, BinaryIO, Callable, Iterable, Iterator, List, Optional, Tuple, Type, TypeVar
+
+import orjson
+from fastapi import FastAPI, UploadFile, File, HTTPException, Body, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from starlette.background import BackgroundTask
+
+try:  # optional: C++ multithreaded CSV reader for big pin sheets
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+except ImportError:  # fall back to stdlib csv
+    pa = pa_csv = None
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Body
 from models import RegisterRow, PinRow
 from mdac_automation import (
+    HEADLESS_DEFAULT,
+    BLOCK_ASSETS,
+    LOG_LEVEL,
+    ContextArtifacts,
+    ContextPool,
+    get_browser,
+    shutdown_browser,
     open_context,
     register_one,
     download_one,
     GATE,
-    _finalize_artifacts,   # finalize: stop trace, close context, resolve video path
+    _finalize_artifacts,   # finalize: stop trace, close/release context, resolve video path
+    _screenshot,
 )
 
-app = FastAPI(title="MDAC Automation API", version="1.0.0")
+app = FastAPI(
+    title="MDAC Automation API",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,  # batch results can be large; orjson encodes them much faster
+)
 
 DOWNLOAD_DIR = Path("./downloads")
 VIDEOS_DIR = Path("./videos")
 DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
 VIDEOS_DIR.mkdir(parents=True, exist_ok=True)
 
-def log(msg: str) -> None:
-    print(f"[API] {msg}", flush=True)
+# Rows processed in parallel per request; each one holds a live browser context,
+# so keep this bounded to avoid running Chromium out of memory.
+MAX_CONCURRENCY = max(1, int(os.getenv("MDAC_CONCURRENCY", "6")))
+
+# CSV rows parsed + validated per threadpool hop.
+CSV_BATCH_ROWS = 256
+
+# API log lines only enqueue on the hot path; a listener thread does the stdout writes,
+# so concurrent rows never serialize on the stdout lock or a per-line flush.
+logger = logging.getLogger("mdac.api")
+logger.setLevel(LOG_LEVEL)  # MDAC_LOG_LEVEL, validated by mdac_automation
+logger.propagate = False
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(_log_queue))
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(logging.Formatter("[API] %(message)s"))
+_log_listener = QueueListener(_log_queue, _log_stream)
+
+T = TypeVar("T")
+
+# ========== Shared browser ==========
+# One Playwright driver + one Chromium per headless flag, started once per worker.
+# Each Chromium comes with a pool of MAX_CONCURRENCY pre-warmed contexts that rows
+# rent instead of creating (and tearing down) their own.
+# The driver is per worker process and not thread-safe: only touch it from the event loop.
+
+@app.on_event("startup")
+async def startup() -> None:
+    _log_listener.start()
+    app.state.pools = {}
+    app.state.browser_lock = asyncio.Lock()
+    await get_pool(app, HEADLESS_DEFAULT, asset_blocking(HEADLESS_DEFAULT, default_pause(HEADLESS_DEFAULT)))
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    for pool in app.state.pools.values():
+        await pool.close()
+    app.state.pools.clear()
+    await shutdown_browser()
+    _log_listener.stop()
+
+async def get_pool(app: FastAPI, headless: Optional[bool], block_assets: bool) -> ContextPool:
+    """
+    Return the shared browser's context pool for this (headless, block_assets) pair,
+    launching it on first use.
+    """
+    if headless is None:
+        headless = HEADLESS_DEFAULT
+    key = (headless, block_assets)
+    async with app.state.browser_lock:
+        pool = app.state.pools.get(key)
+        if pool is None or not pool.browser.is_connected():
+            browser = await get_browser(headless)
+            pool = await ContextPool(browser, MAX_CONCURRENCY, block_assets=block_assets).start()
+            app.state.pools[key] = pool
+    return pool
 
 def default_pause(headless: Optional[bool]) -> bool:
     """Pause only when running headful (so you can solve CAPTCHA)."""
     if headless is None:
-        headless = os.getenv("HEADLESS", "1") == "1"
+        headless = HEADLESS_DEFAULT
     return not headless
 
+def asset_blocking(headless: Optional[bool], pause: bool) -> bool:
+    """Block images/fonts only for unattended runs: a human solving a CAPTCHA needs its image."""
+    if headless is None:
+        headless = HEADLESS_DEFAULT
+    return BLOCK_ASSETS and headless and not pause
+
 
 # ========== CSV parsers ==========
 
-async def parse_csv_register(f: UploadFile) -> List[RegisterRow]:
-    raw = await f.read()
-    text = raw.decode("utf-8-sig")
-    reader = csv.DictReader(io.StringIO(text))
-    rows: List[RegisterRow] = [RegisterRow(**r) for r in reader]
-    if not rows:
+def _csv_records(fileobj: BinaryIO, model: Type[BaseModel]) -> Iterator[dict]:
+    """
+    Yield CSV records straight from the spooled upload, never holding the whole payload
+    as bytes + str. Uses pyarrow's multithreaded block reader when installed (all model
+    columns forced to string so codes like '0100' keep their zeros), else stdlib csv.
+    Both paths reject ragged rows (field count != header) with a 400, so whether an
+    upload is accepted never depends on pyarrow being installed.
+    """
+    if pa_csv is not None:
+        # Only the model's columns are parsed (all as strings), so a stray extra column
+        # can't be type-inferred from the first block and then fail on a later one.
+        convert = pa_csv.ConvertOptions(
+            column_types={name: pa.string() for name in model.model_fields},
+            include_columns=list(model.model_fields),
+            include_missing_columns=True,
+        )
+        try:
+            reader = pa_csv.open_csv(
+                fileobj,
+                read_options=pa_csv.ReadOptions(use_threads=True),
+                parse_options=pa_csv.ParseOptions(newlines_in_values=True),  # quoted multi-line cells
+                convert_options=convert,
+            )
+            for batch in reader:
+                # Missing columns come back all-null (empty cells are ""): drop them so
+                # pydantic applies field defaults / reports "field required" as before.
+                for rec in batch.to_pylist():
+                    yield {k: v for k, v in rec.items() if v is not None}
+        except pa.ArrowInvalid as e:
+            raise HTTPException(status_code=400, detail=f"Malformed CSV: {e}")
+        return
+
+    text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    try:
+        reader = csv.reader(text)
+        header = next(reader, None) or []
+        n = 0
+        for fields in reader:
+            if not fields:
+                continue  # blank line, skipped like DictReader / pyarrow do
+            n += 1
+            if len(fields) != len(header):
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Malformed CSV: row {n} has {len(fields)} fields, expected {len(header)}",
+                )
+            yield dict(zip(header, fields))
+    except csv.Error as e:
+        raise HTTPException(status_code=400, detail=f"Malformed CSV: {e}")
+    finally:
+        text.detach()  # leave the upload's file open for Starlette to clean up
+
+# One pydantic-core call validates a whole batch instead of re-entering per row.
+_ROW_ADAPTERS = {
+    RegisterRow: TypeAdapter(List[RegisterRow]),
+    PinRow: TypeAdapter(List[PinRow]),
+}
+
+def _parse_batch(records: Iterator[dict], adapter: TypeAdapter, size: int, offset: int) -> list:
+    """Validate the next `size` records; `offset` is how many data rows came before them."""
+    try:
+        return adapter.validate_python(list(islice(records, size)))
+    except ValidationError as e:
+        err = e.errors()[0]
+        idx, *field = err["loc"]
+        where = f"row {offset + idx + 1}" + (f", column '{field[0]}'" if field else "")
+        raise HTTPException(status_code=400, detail=f"Invalid CSV {where}: {err['msg']}")
+
+async def _iter_csv_rows(f: UploadFile, model: Type[BaseModel]) -> AsyncIterator[BaseModel]:
+    """
+    Read + validate in the threadpool, CSV_BATCH_ROWS at a time, so big uploads never
+    block the event loop that drives the in-flight Playwright pages.
+    """
+    await f.seek(0)
+    adapter = _ROW_ADAPTERS[model]
+    records = _csv_records(f.file, model)
+    offset = 0
+    try:
+        while True:
+            batch = await run_in_threadpool(_parse_batch, records, adapter, CSV_BATCH_ROWS, offset)
+            if not batch:
+                break
+            offset += len(batch)
+            for row in batch:
+                yield row
+    finally:
+        records.close()
+
+async def parse_csv_register(f: UploadFile) -> AsyncIterator[RegisterRow]:
+    empty = True
+    async for row in _iter_csv_rows(f, RegisterRow):
+        empty = False
+        yield row
+    if empty:
         raise HTTPException(status_code=400, detail="register.csv is empty or has no valid rows.")
-    return rows
-
-async def parse_csv_pins(f: UploadFile) -> List[PinRow]:
-    raw = await f.read()
-    text = raw.decode("utf-8-sig")
-    reader = csv.DictReader(io.StringIO(text))
-    rows: List[PinRow] = [PinRow(**r) for r in reader]
-    if not rows:
+
+async def parse_csv_pins(f: UploadFile) -> AsyncIterator[PinRow]:
+    empty = True
+    async for row in _iter_csv_rows(f, PinRow):
+        empty = False
+        yield row
+    if empty:
         raise HTTPException(status_code=400, detail="pins.csv is empty or has no valid rows.")
-    return rows
+
+# ========== Row workers ==========
+
+def _row_result(passport: str, artifacts: ContextArtifacts, **fields) -> dict:
+    """Result dict for one finished row: passport, flow-specific fields, then artifact paths."""
+    return {
+        "passport": passport,
+        **fields,
+        "video": os.fspath(artifacts.video_path) if artifacts.video_path else None,
+        "trace": os.fspath(artifacts.trace_path) if artifacts.trace_path else None,
+    }
+
+async def _process_register_row(
+    pool: ContextPool,
+    row: RegisterRow,
+    record: bool,
+    headless: Optional[bool],
+    pause: bool,
+    block_assets: bool,
+    label: str = "",
+) -> dict:
+    """Register one traveler in its own context; errors are returned, not raised."""
+    logger.info("Register %s %s headless=%s record=%s pause=%s", label, row.passport, headless, record, pause)
+    video_dir = (VIDEOS_DIR / row.passport) if record else None
+
+    # Rent a pooled context (or a fresh recording one) and open a page (returns 3 values)
+    try:
+        context, page, artifacts = await open_context(
+            pool.browser,
+            record_video_dir=video_dir,
+            pool=pool,
+            block_assets=block_assets and video_dir is None,
+        )
+    except Exception as e:
+        logger.error("Register %s %s failed to open context: %s", label, row.passport, e)
+        return {"passport": row.passport, "error": str(e)}
+
+    try:
+        token = secrets.token_hex(4) if pause else None
+        info = await register_one(page, row, gate_token=token, pause=pause)
+
+        # Finalize artifacts: stop trace, close/release context, resolve video path
+        artifacts = await _finalize_artifacts(context, page, artifacts, video_dir, pool)
+
+        logger.info("Register %s %s done", label, row.passport)
+        return _row_result(row.passport, artifacts, gate_token=token, paused=pause, info=info)
+    except asyncio.CancelledError:
+        # Batch aborted (client gone): still close/release the context before unwinding
+        try:
+            await _finalize_artifacts(context, page, artifacts, video_dir, pool)
+        except Exception:
+            pass
+        raise
+    except Exception as e:
+        logger.error("Register %s %s failed: %s", label, row.passport, e)
+        await _screenshot(page, "99_error", error=True)
+        # Try to finalize artifacts even on error
+        try:
+            await _finalize_artifacts(context, page, artifacts, video_dir, pool)
+        except Exception:
+            pass
+        return {"passport": row.passport, "error": str(e)}
+
+async def _process_download_row(
+    pool: ContextPool,
+    row: PinRow,
+    record: bool,
+    headless: Optional[bool],
+    label: str = "",
+) -> dict:
+    """Download one traveler's PDF in its own context; errors are returned, not raised."""
+    logger.info("Download %s %s headless=%s record=%s", label, row.passport, headless, record)
+    video_dir = (VIDEOS_DIR / f"{row.passport}_download") if record else None
+
+    try:
+        context, page, artifacts = await open_context(
+            pool.browser,
+            download_dir=DOWNLOAD_DIR,
+            record_video_dir=video_dir,
+            pool=pool,
+            block_assets=pool.block_assets and video_dir is None,
+        )
+    except Exception as e:
+        logger.error("Download %s %s failed to open context: %s", label, row.passport, e)
+        return {"passport": row.passport, "error": str(e)}
+
+    try:
+        pdf_path = await download_one(page, row, DOWNLOAD_DIR)
+
+        artifacts = await _finalize_artifacts(context, page, artifacts, video_dir, pool)
+
+        logger.info("Download %s %s done saved=%s", label, row.passport, bool(pdf_path))
+        return _row_result(
+            row.passport, artifacts, saved=bool(pdf_path), file=os.fspath(pdf_path) if pdf_path else None,
+        )
+    except asyncio.CancelledError:
+        # Batch aborted (client gone): still close/release the context before unwinding
+        try:
+            await _finalize_artifacts(context, page, artifacts, video_dir, pool)
+        except Exception:
+            pass
+        raise
+    except Exception as e:
+        logger.error("Download %s %s failed: %s", label, row.passport, e)
+        await _screenshot(page, "99_error", error=True)
+        try:
+            await _finalize_artifacts(context, page, artifacts, video_dir, pool)
+        except Exception:
+            pass
+        return {"passport": row.passport, "error": str(e)}
+
+# ========== Batch pipeline ==========
+
+async def _aiter(rows: Iterable[T]) -> AsyncIterator[T]:
+    for row in rows:
+        yield row
+
+async def _iter_pipeline(
+    rows: AsyncIterator[T],
+    worker: Callable[[T, str], Awaitable[dict]],
+    total: Optional[int] = None,
+) -> AsyncIterator[Tuple[int, dict]]:
+    """
+    Feed rows through a bounded queue to MAX_CONCURRENCY consumers, so automation starts
+    as soon as the first row is parsed and a slow automation stage back-pressures parsing.
+    Yields (1-based input index, result) in completion order; a parse error is raised
+    once the rows queued before it have finished. Closing the generator early (client
+    gone) cancels the producer and any rows still running.
+    """
+    q_in: asyncio.Queue = asyncio.Queue(maxsize=2 * MAX_CONCURRENCY)
+    q_out: asyncio.Queue = asyncio.Queue()
+
+    async def produce() -> None:
+        try:
+            idx = 0
+            async for row in rows:
+                idx += 1
+                await q_in.put((idx, row))
+        finally:
+            for _ in range(MAX_CONCURRENCY):
+                await q_in.put(None)
+
+    async def consume() -> None:
+        try:
+            while (item := await q_in.get()) is not None:
+                idx, row = item
+                result = await worker(row, f"[{idx}/{total}]" if total else f"[{idx}]")
+                await q_out.put((idx, result))
+        finally:
+            await q_out.put(None)
+
+    producer = asyncio.create_task(produce())
+    consumers = [asyncio.create_task(consume()) for _ in range(MAX_CONCURRENCY)]
+    try:
+        running = len(consumers)
+        while running:
+            item = await q_out.get()
+            if item is None:
+                running -= 1
+            else:
+                yield item
+        await producer
+    finally:
+        # No-ops after a normal finish; on early close the row workers release their contexts
+        for task in (producer, *consumers):
+            task.cancel()
+        await asyncio.gather(producer, *consumers, return_exceptions=True)
+
+def _detach_upload(f: UploadFile) -> UploadFile:
+    """
+    FastAPI closes form uploads as soon as the endpoint returns, i.e. before a
+    StreamingResponse body runs. Move the spooled file to an UploadFile that only we
+    close (via a background task), leaving an empty stand-in for FastAPI.
+    """
+    owned = UploadFile(f.file, size=f.size, filename=f.filename, headers=f.headers)
+    f.file = io.BytesIO()
+    return owned
+
+async def _collect(results: AsyncIterator[Tuple[int, dict]]):
+    """
+    Gather every row into one body, in input order. If the CSV turns out to be bad
+    mid-way, rows already submitted are still reported next to the error.
+    """
+    done: List[Tuple[int, dict]] = []
+    try:
+        async for item in results:
+            done.append(item)
+    except Exception as e:
+        status, detail = (e.status_code, e.detail) if isinstance(e, HTTPException) else (500, str(e))
+        logger.error("Batch aborted after %d rows: %s", len(done), detail)
+        done.sort(key=lambda item: item[0])
+        return ORJSONResponse(
+            status_code=status,
+            content={"ok": False, "count": len(done), "rows": [result for _, result in done], "error": detail},
+        )
+    finally:
+        await results.aclose()  # stop the pipeline's tasks if this request is cancelled
+    done.sort(key=lambda item: item[0])
+    return {"ok": True, "count": len(done), "rows": [result for _, result in done]}
+
+async def _ndjson(results: AsyncIterator[Tuple[int, dict]]) -> AsyncIterator[bytes]:
+    """One JSON line per finished row, then a summary line like the non-streaming body."""
+    count = 0
+    try:
+        async for _, result in results:
+            count += 1
+            yield orjson.dumps(result) + b"\n"
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        logger.error("Stream aborted after %d rows: %s", count, detail)
+        yield orjson.dumps({"ok": False, "count": count, "error": detail}) + b"\n"
+        return
+    finally:
+        await results.aclose()  # client disconnect: stop the rows still running
+    yield orjson.dumps({"ok": True, "count": count}) + b"\n"
+
+async def _register_batch(
+    app: FastAPI,
+    rows: AsyncIterator[RegisterRow],
+    total: Optional[int],
+    record: bool,
+    headless: Optional[bool],
+    pause: Optional[bool],
+    stream: bool = False,
+):
+    if pause is None:
+        pause = default_pause(headless)
+    block_assets = asset_blocking(headless, pause)
+    pool = await get_pool(app, headless, block_assets)
+
+    async def worker(row: RegisterRow, label: str) -> dict:
+        return await _process_register_row(
+            pool, row, record=record, headless=headless, pause=pause, block_assets=block_assets, label=label,
+        )
+
+    results = _iter_pipeline(rows, worker, total)
+    if stream:
+        return StreamingResponse(_ndjson(results), media_type="application/x-ndjson")
+    return await _collect(results)
+
+async def _download_batch(
+    app: FastAPI,
+    rows: AsyncIterator[PinRow],
+    total: Optional[int],
+    record: bool,
+    headless: Optional[bool],
+    stream: bool = False,
+):
+    pool = await get_pool(app, headless, asset_blocking(headless, pause=False))
+
+    async def worker(row: PinRow, label: str) -> dict:
+        return await _process_download_row(pool, row, record=record, headless=headless, label=label)
+
+    results = _iter_pipeline(rows, worker, total)
+    if stream:
+        return StreamingResponse(_ndjson(results), media_type="application/x-ndjson")
+    return await _collect(results)
 
 # ========== Endpoints ==========
 
 @app.post("/register")
 async def register_rows(
+    request: Request,
     rows: List[RegisterRow] = Body(..., description="Array of traveler objects"),
     record: bool = False,
     headless: Optional[bool] = None,
     pause: Optional[bool] = None,
+    stream: bool = False,
 ):
     """
     JSON body-based registration. For CSV, use /register-csv.
     Use query params: ?record=1&headless=0&pause=1 for desktop/headful with CAPTCHA solving.
+    Rows run concurrently, at most MDAC_CONCURRENCY at a time.
+    ?stream=1 returns NDJSON: one line per row as it finishes, then a summary line.
     """
-    if pause is None:
-        pause = default_pause(headless)
-
-    results = []
-    total = len(rows)
-    for idx, row in enumerate(rows, 1):
-        log(f"Register [{idx}/{total}] {row.passport} headless={headless} record={record} pause={pause}")
-        video_dir = (VIDEOS_DIR / row.passport) if record else None
-
-        # Create a fresh context/page (returns 3 values)
-        context, page, artifacts = await open_context(
-            headless=headless,
-            record_video_dir=video_dir,
-        )
-        try:
-            token = uuid.uuid4().hex[:8] if pause else None
-            info = await register_one(page, row, gate_token=token, pause=pause)
-
-            # Finalize artifacts: stop trace, close context, resolve video path
-            artifacts = await _finalize_artifacts(context, page, artifacts, video_dir)
-
-            results.append({
-                "passport": row.passport,
-                "gate_token": token,
-                "paused": pause,
-                "info": info,
-                "video": str(artifacts.video_path) if artifacts.video_path else None,
-                "trace": str(artifacts.trace_path) if artifacts.trace_path else None,
-            })
-        except Exception as e:
-            # Try to finalize artifacts even on error
-            try:
-                await _finalize_artifacts(context, page, artifacts, video_dir)
-            except Exception:
-                pass
-            results.append({"passport": row.passport, "error": str(e)})
-
-    return {"ok": True, "count": len(results), "rows": results}
+    return await _register_batch(request.app, _aiter(rows), len(rows), record, headless, pause, stream)
 
 @app.post("/register-csv")
 async def register_csv(
+    request: Request,
     file: UploadFile = File(...),
     record: bool = False,
     headless: Optional[bool] = None,
     pause: Optional[bool] = None,
+    stream: bool = False,
 ):
-    """CSV upload-based registration."""
-    rows = await parse_csv_register(file)
-    return await register_rows(rows=rows, record=record, headless=headless, pause=pause)
+    """CSV upload-based registration; rows start automating while the rest is still being parsed."""
+    if stream:
+        file = _detach_upload(file)
+    response = await _register_batch(request.app, parse_csv_register(file), None, record, headless, pause, stream)
+    if stream:
+        response.background = BackgroundTask(file.close)
+    return response
 
 @app.post("/resume/{token}")
 async def resume(token: str):
@@ -125,51 +531,30 @@ async def resume(token: str):
 
 @app.post("/download")
 async def download_rows(
+    request: Request,
     rows: List[PinRow] = Body(..., description="Array of {passport,nationality,pin} objects"),
     record: bool = False,
     headless: Optional[bool] = None,
+    stream: bool = False,
 ):
-    out = []
-    total = len(rows)
-    for idx, row in enumerate(rows, 1):
-        log(f"Download [{idx}/{total}] {row.passport} headless={headless} record={record}")
-        video_dir = (VIDEOS_DIR / f"{row.passport}_download") if record else None
-
-        context, page, artifacts = await open_context(
-            download_dir=DOWNLOAD_DIR,
-            headless=headless,
-            record_video_dir=video_dir,
-        )
-        try:
-            pdf_path = await download_one(page, row, DOWNLOAD_DIR)
-
-            artifacts = await _finalize_artifacts(context, page, artifacts, video_dir)
-
-            out.append({
-                "passport": row.passport,
-                "saved": bool(pdf_path),
-                "file": str(pdf_path) if pdf_path else None,
-                "video": str(artifacts.video_path) if artifacts.video_path else None,
-                "trace": str(artifacts.trace_path) if artifacts.trace_path else None,
-            })
-        except Exception as e:
-            try:
-                await _finalize_artifacts(context, page, artifacts, video_dir)
-            except Exception:
-                pass
-            out.append({"passport": row.passport, "error": str(e)})
-
-    return {"ok": True, "count": len(out), "rows": out}
+    """JSON body-based PDF download. ?stream=1 returns NDJSON like /register."""
+    return await _download_batch(request.app, _aiter(rows), len(rows), record, headless, stream)
 
 @app.post("/download-csv")
 async def download_csv(
+    request: Request,
     file: UploadFile = File(...),
     record: bool = False,
     headless: Optional[bool] = None,
+    stream: bool = False,
 ):
     """CSV upload-based download (pins.csv)."""
-    rows = await parse_csv_pins(file)
-    return await download_rows(rows=rows, record=record, headless=headless)
+    if stream:
+        file = _detach_upload(file)
+    response = await _download_batch(request.app, parse_csv_pins(file), None, record, headless, stream)
+    if stream:
+        response.background = BackgroundTask(file.close)
+    return response
 
 @app.get("/health")
 async def health():
@@ -1,13 +1,24 @@
 from __future__ import annotations
 import asyncio
+import atexit
+import errno
+import io
+import json
+import logging
 import os
 import re
+import sys
+import threading
 import traceback
+from collections import Counter
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, Pattern, Tuple, Sequence
+from time import monotonic_ns
+from typing import AsyncIterator, Optional, Pattern, Sequence, TextIO, Tuple, Union
 
-from playwright.async_api import async_playwright, Page, BrowserContext
+from playwright.async_api import Browser, BrowserContext, Download, Page, Playwright, Route, async_playwright
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
 
 # =============================================================================
 # MDAC Automation — ultra-verbose debug build
@@ -19,28 +30,142 @@ from playwright.async_api import async_playwright, Page, BrowserContext
 BASE = "https://imigresen-online.imi.gov.my/mdac/main"
 HEADLESS_DEFAULT = os.getenv("HEADLESS", "1") == "1"            # headless by default in Docker
 LOG_NETWORK = os.getenv("LOG_NETWORK", "1") == "1"              # <— default ON for deep debug
+LOG_CONSOLE = os.getenv("LOG_CONSOLE", "1") == "1"              # browser console + pageerror
+LOG_DIALOGS = os.getenv("LOG_DIALOGS", "1") == "1"              # log+dismiss alerts (else auto-dismissed)
+LOG_NAVIGATION = os.getenv("LOG_NAVIGATION", "1") == "1"        # one line per frame navigation
 GATE_WAIT_SECONDS = int(os.getenv("GATE_WAIT_SECONDS", "120"))
 RECORD_TRACE = os.getenv("RECORD_TRACE", "1") == "1"            # keep traces for debugging
+LOGGED_RESOURCE_TYPES = frozenset({"document", "xhr", "fetch"})  # per-line network logs
+SCREENSHOT_LEVEL = os.getenv("SCREENSHOT_LEVEL", "all").lower()  # none | error | all (recorded rows only)
+FULL_PAGE_SCREENSHOTS = os.getenv("MDAC_FULL_SCREEN", "0") == "1" # viewport-only JPEG by default
+BLOCK_ASSETS = os.getenv("MDAC_BLOCK_ASSETS", "1") == "1"        # abort images/fonts/media/trackers
+BLOCK_STYLESHEETS = os.getenv("MDAC_BLOCK_CSS", "0") == "1"      # also CSS (only if the flows survive it)
+POOL_RENT_TIMEOUT = float(os.getenv("MDAC_POOL_RENT_TIMEOUT", "5"))  # then fall back to a dedicated context
+WARM_STATE_PATH = os.getenv("MDAC_WARM_STATE", "/tmp/mdac_warm_state.json")  # "" = keep in memory only
+
+# ===== Patterns (compiled once, used per row) =====
+_RE_PERSONAL_INFO = re.compile(r"personal information", re.I)
+_RE_TRAVEL = re.compile(r"travel", re.I)
+_RE_MOBILE_PREFIX = re.compile(r"^\+?\d{1,3}\s*[-]?\s*")
+_RE_CHECK = re.compile(r"(check registration|check|retrieve)", re.I)
+_RE_SUBMIT = re.compile(r"(submit|check|search)", re.I)
+_RE_DOWNLOAD_BTN = re.compile(r"(download|print)", re.I)
+_RE_DOWNLOAD = re.compile(r"(download|print|pdf)", re.I)
+_RE_NONDIGIT = re.compile(r"[^\d+]")
+_RE_REGION = re.compile(r"^\+?0{0,2}(\d{1,3})")
+_RE_DATE_YMD = re.compile(r"^(\d{4})-(\d{2})-(\d{2})$")        # YYYY-MM-DD
+_RE_DATE_DMY_DASH = re.compile(r"^(\d{2})-(\d{2})-(\d{4})$")   # DD-MM-YYYY
+_RE_DATE_DMY_SLASH = re.compile(r"^(\d{2})/(\d{2})/(\d{4})$")  # DD/MM/YYYY
+
+# ===== Logging =====
+class PrintBuffer:
+    """
+    File-like sink that collects log lines in memory and writes them to stdout in one
+    go every `interval` seconds (or once `max_bytes` pile up), instead of one
+    write()+flush() per line. Network listeners can fire hundreds of lines per page.
+    """
+    def __init__(self, stream: Optional[TextIO] = None, interval: float = 0.1, max_bytes: int = 64 * 1024):
+        self._stream = stream  # None -> sys.stdout at drain time
+        self._interval = interval
+        self._max_bytes = max_bytes
+        self._lock = threading.RLock()
+        self._buf = io.StringIO()
+        self._size = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def write(self, s: str) -> int:
+        with self._lock:
+            self._buf.write(s)
+            self._size += len(s)
+            drain_now = self._size >= self._max_bytes
+            if not drain_now and self._timer is None:
+                try:
+                    loop = asyncio.get_running_loop()
+                except RuntimeError:
+                    drain_now = True  # no loop in this thread to flush later
+                else:
+                    self._timer = loop.call_later(self._interval, self.drain)
+        if drain_now:
+            self.drain()
+        return len(s)
+
+    def drain(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            data = self._buf.getvalue()
+            if not data:
+                return
+            self._buf = io.StringIO()
+            self._size = 0
+            stream = self._stream or sys.stdout
+            stream.write(data)
+            stream.flush()
+
+    def flush(self) -> None:
+        """No-op: StreamHandler flushes after every record; the timer/atexit drain instead."""
+
+
+PRINT_BUFFER = PrintBuffer()
+atexit.register(PRINT_BUFFER.drain)
+
+
+def _log_level(raw: str) -> Optional[int]:
+    """MDAC_LOG_LEVEL accepts a number (20) or a level name (INFO); None if it is neither."""
+    raw = raw.strip()
+    if raw.isdigit():
+        return int(raw)
+    level = logging.getLevelName(raw.upper())
+    return level if isinstance(level, int) else None  # unknown names come back as "Level X"
+
+
+_RAW_LOG_LEVEL = os.getenv("MDAC_LOG_LEVEL") or "20"
+LOG_LEVEL = _log_level(_RAW_LOG_LEVEL)
+logger = logging.getLogger("mdac")
+logger.setLevel(LOG_LEVEL or logging.INFO)
+logger.propagate = False
+if not logger.handlers:
+    _handler = logging.StreamHandler(PRINT_BUFFER)
+    _handler.setFormatter(logging.Formatter("[MDAC] %(message)s"))
+    logger.addHandler(_handler)
+if LOG_LEVEL is None:
+    LOG_LEVEL = logging.INFO
+    logger.warning("⚠️  Unknown MDAC_LOG_LEVEL %r; using INFO", _RAW_LOG_LEVEL)
+
+
+class _ExcText:
+    """Formats an exception only if the record is actually emitted."""
+    __slots__ = ("e", "full")
+
+    def __init__(self, e: BaseException, full: bool = False):
+        self.e = e
+        self.full = full
+
+    def __str__(self) -> str:
+        e = self.e
+        if self.full:
+            return "".join(traceback.format_exception(type(e), e, e.__traceback__)).rstrip()
+        return "".join(traceback.format_exception_only(type(e), e)).strip()
+
 
 def log(msg: str) -> None:
-    print(f"[MDAC] {msg}", flush=True)
+    logger.info(msg)
 
 def log_ok(step: str) -> None:
-    log(f"✅ {step}")
+    logger.info("✅ %s", step)
 
 def log_warn(step: str) -> None:
-    log(f"⚠️  {step}")
+    logger.warning("⚠️  %s", step)
 
 def log_err(step: str, e: BaseException | None = None) -> None:
     if e:
-        tb = "".join(traceback.format_exception_only(type(e), e)).strip()
-        log(f"❌ {step} -> {tb}")
+        logger.error("❌ %s -> %s", step, _ExcText(e))
     else:
-        log(f"❌ {step}")
+        logger.error("❌ %s", step)
 
 def log_exc(step: str, e: BaseException) -> None:
-    tb = "".join(traceback.format_exception(type(e), e, e.__traceback__)).rstrip()
-    log(f"💥 {step}\n{tb}")
+    logger.error("💥 %s\n%s", step, _ExcText(e, full=True))
 
 async def log_exists(page: Page, sel: str, timeout=1500) -> bool:
     try:
@@ -79,129 +204,417 @@ class ContextArtifacts:
     screenshots_dir: Optional[Path] = None
 
 
+# ===== Filesystem =====
+_created_dirs: set[Path] = set()
+
+
+async def _ensure_dir(p: Path) -> None:
+    """mkdir -p off the event loop, once per path per process."""
+    if p in _created_dirs:
+        return
+    await asyncio.to_thread(p.mkdir, parents=True, exist_ok=True)
+    _created_dirs.add(p)
+
+
 # ===== Listeners / screenshots =====
 async def _attach_listeners(page: Page) -> None:
+    """
+    Wire only the listeners whose logs are enabled: every handler is a CDP-to-Python
+    dispatch per browser event. Without a dialog listener Playwright auto-dismisses.
+    """
     def safe(fn):
-        async def wrap(*args, **kwargs):
+        def wrap(*args, **kwargs):
             try:
-                res = fn(*args, **kwargs)
-                if asyncio.iscoroutine(res):
-                    await res
+                fn(*args, **kwargs)
             except Exception as e:
                 log_exc("Listener error", e)
         return wrap
 
-    @safe
-    def on_console(m):
-        t = ""
-        try:
-            t = getattr(m, "type", "") or ""
-        except Exception:
-            pass
-        try:
-            txt = m.text()
-        except Exception:
-            txt = "<console message unavailable>"
-        log(f"BROWSER {str(t).upper()}: {txt}")
+    if LOG_CONSOLE:
+        @safe
+        def on_console(m):
+            t = ""
+            try:
+                t = getattr(m, "type", "") or ""
+            except Exception:
+                pass
+            try:
+                txt = m.text
+            except Exception:
+                txt = "<console message unavailable>"
+            log(f"BROWSER {str(t).upper()}: {txt}")
 
-    @safe
-    def on_pageerror(e):
-        log_err("BROWSER pageerror", e)
+        @safe
+        def on_pageerror(e):
+            log_err("BROWSER pageerror", e)
 
-    @safe
-    def on_dialog(dlg):
-        log(f"Dialog: {dlg.type} {dlg.message}")
-        try:
-            dlg.dismiss()
-        except Exception:
-            pass
+        page.on("console", on_console)
+        page.on("pageerror", on_pageerror)
+
+    if LOG_DIALOGS:
+        async def on_dialog(dlg):
+            log(f"Dialog: {dlg.type} {dlg.message}")
+            try:
+                await dlg.dismiss()
+            except Exception as e:
+                log_warn(f"Dialog dismiss failed: {e}")
 
-    page.on("console", on_console)
-    page.on("pageerror", on_pageerror)
-    page.on("dialog", on_dialog)
+        page.on("dialog", on_dialog)
 
     if LOG_NETWORK:
+        # Only page/API traffic gets a line each; assets are just counted and summarized
+        # once per row by _finalize_artifacts (failures and 4xx/5xx are always logged).
+        stats: Counter = Counter()
+        setattr(page, "_mdac_net_stats", stats)
+
         @safe
         def on_request(r):
-            try:
+            if r.resource_type in LOGGED_RESOURCE_TYPES:
                 log(f"REQ {r.method} {r.url}")
-            except Exception as e:
-                log_err("REQ log failed", e)
 
         @safe
         def on_response(r):
-            try:
+            stats[(r.request.method, r.status)] += 1
+            if r.status >= 400 or r.request.resource_type in LOGGED_RESOURCE_TYPES:
                 log(f"RES {r.status} {r.url}")
-            except Exception as e:
-                log_err("RES log failed", e)
 
         @safe
         def on_request_failed(r):
-            try:
-                log(f"REQ-FAILED {r.method} {r.url} -> {r.failure.error_text if r.failure else '?'}")
-            except Exception as e:
-                log_err("REQ-FAILED log failed", e)
+            stats[(r.method, "failed")] += 1
+            log(f"REQ-FAILED {r.method} {r.url} -> {r.failure or '?'}")
 
         page.on("request", on_request)
         page.on("response", on_response)
         page.on("requestfailed", on_request_failed)
 
-    @safe
-    def on_framenav(frame):
-        try:
+    if LOG_NAVIGATION:
+        @safe
+        def on_framenav(frame):
             log(f"FRAME NAV -> {frame.url}")
-        except Exception:
-            pass
 
-    page.on("framenavigated", on_framenav)
+        page.on("framenavigated", on_framenav)
+
+
+def _log_net_summary(page: Page) -> None:
+    stats: Optional[Counter] = getattr(page, "_mdac_net_stats", None)
+    if not stats:
+        return
+    parts = ", ".join(f"{method} {status} x{n}" for (method, status), n in sorted(stats.items(), key=str))
+    log(f"NET summary ({sum(stats.values())} responses): {parts}")
+    stats.clear()
 
 
 def _get_screens_dir(page: Page) -> Optional[Path]:
     return getattr(page, "_mdac_screens", None)
 
 
-async def _screenshot(page: Page, name: str) -> None:
+async def _screenshot(page: Page, name: str, error: bool = False) -> None:
+    """Viewport JPEG (q=60) of a recorded page; `error` shots are kept even at SCREENSHOT_LEVEL=error."""
+    if SCREENSHOT_LEVEL == "none" or (SCREENSHOT_LEVEL == "error" and not error):
+        return
     target_dir = _get_screens_dir(page)
     if not target_dir:
         return
     try:
-        target_dir.mkdir(parents=True, exist_ok=True)
-        path = target_dir / f"{name}.png"
-        await page.screenshot(path=str(path), full_page=True)
+        await _ensure_dir(target_dir)
+        path = target_dir / f"{name}.jpg"
+        await page.screenshot(path=str(path), type="jpeg", quality=60, full_page=FULL_PAGE_SCREENSHOTS)
         log_ok(f"Screenshot: {path}")
     except Exception as e:
         log_err(f"screenshot failed ({name})", e)
 
 
+# ===== Warm session state =====
+# Shareable cookies captured from the first clean landing-page load (before any
+# traveler data is typed), then seeded into later contexts so rows 2..N skip the
+# cold-session warm-up. Session/auth cookies and localStorage are never kept: rows run
+# concurrently and each must get its own server-side session (form + CAPTCHA state).
+# Persisted (0600) to WARM_STATE_PATH so a restarted process starts warm.
+_warm_lock = asyncio.Lock()
+_RE_SESSION_COOKIE = re.compile(r"sess|auth|token|csrf|xsrf|login|jwt|sid$", re.I)
+
+
+def _shareable_state(state: dict) -> dict:
+    """Keep only persistent, non-session cookies; drop per-origin storage."""
+    cookies = [
+        c for c in state.get("cookies", [])
+        if c.get("expires", -1) > 0 and not _RE_SESSION_COOKIE.search(c.get("name", ""))
+    ]
+    return {"cookies": cookies, "origins": []}
+
+
+def _write_warm_state(state: dict) -> None:
+    fd = os.open(WARM_STATE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)  # an older file may have been created world-readable
+    with os.fdopen(fd, "w", encoding="utf-8") as fh:
+        json.dump(state, fh)
+
+
+def _load_warm_state() -> Optional[dict]:
+    if not WARM_STATE_PATH or not os.path.isfile(WARM_STATE_PATH):
+        return None
+    try:
+        with open(WARM_STATE_PATH, "r", encoding="utf-8") as fh:
+            return _shareable_state(json.load(fh))
+    except Exception as e:
+        log_err(f"Warm state at {WARM_STATE_PATH} unreadable; ignoring", e)
+        return None
+
+
+_warm_state: Optional[dict] = _load_warm_state()
+
+
+async def remember_warm_state(context: BrowserContext) -> None:
+    global _warm_state
+    if _warm_state is not None:
+        return
+    async with _warm_lock:
+        if _warm_state is not None:
+            return
+        try:
+            _warm_state = _shareable_state(await context.storage_state())
+            log_ok(f"Warm state captured: {len(_warm_state['cookies'])} shareable cookies")
+            if WARM_STATE_PATH:
+                await asyncio.to_thread(_write_warm_state, _warm_state)
+        except Exception as e:
+            log_err("Warm state capture failed", e)
+
+
+def forget_warm_state() -> None:
+    global _warm_state
+    if _warm_state is not None:
+        log_warn("Warm state dropped")
+    _warm_state = None
+    if WARM_STATE_PATH:
+        try:
+            os.remove(WARM_STATE_PATH)
+        except OSError:
+            pass
+
+
 # ===== Browser / context =====
-async def open_context(
-    download_dir: Optional[Path] = None,
-    headless: Optional[bool] = None,
-    record_video_dir: Optional[Path] = None,
-) -> Tuple[BrowserContext, Page, ContextArtifacts]:
+CHROMIUM_ARGS = ["--no-sandbox", "--disable-dev-shm-usage", "--start-maximized"]
+
+
+async def launch_browser(pw: Playwright, headless: Optional[bool] = None) -> Browser:
     """
-    Create a fresh context/page. If record_video_dir is set, we record video and store
-    screenshots under <record_video_dir>/screens. Also starts Playwright trace if enabled.
+    Launch one Chromium for the whole process. `pw` is the caller's long-lived driver
+    (started once, never per row); callers keep the browser around and open a cheap
+    BrowserContext per traveler via open_context().
     """
     if headless is None:
         headless = HEADLESS_DEFAULT
-
-    pw = await async_playwright().start()
     log(f"Launching Chromium headless={headless}")
-    browser = await pw.chromium.launch(
-        headless=headless,
-        args=["--no-sandbox", "--disable-dev-shm-usage", "--start-maximized"],
-    )
+    return await pw.chromium.launch(headless=headless, args=CHROMIUM_ARGS)
+
+
+# One Playwright driver per process, one Browser per headless flag.
+_PW: Optional[Playwright] = None
+_BROWSERS: dict[bool, Browser] = {}
+_browser_lock = asyncio.Lock()
 
-    ctx_kwargs = {
+
+async def get_browser(headless: Optional[bool] = None) -> Browser:
+    """Return the process-wide Browser for this headless flag, (re)launching it on demand."""
+    global _PW
+    if headless is None:
+        headless = HEADLESS_DEFAULT
+    async with _browser_lock:
+        browser = _BROWSERS.get(headless)
+        if browser is None or not browser.is_connected():
+            if _PW is None:
+                # Spawns the Node driver subprocess; never started anywhere else
+                _PW = await async_playwright().start()
+            browser = await launch_browser(_PW, headless=headless)
+            _BROWSERS[headless] = browser
+    return browser
+
+
+async def shutdown_browser() -> None:
+    """Close every shared Browser and stop the Playwright driver (process teardown)."""
+    global _PW
+    async with _browser_lock:
+        for browser in _BROWSERS.values():
+            try:
+                await browser.close()
+            except Exception as e:
+                log_warn(f"Browser close failed: {e}")
+        _BROWSERS.clear()
+        if _PW is not None:
+            await _PW.stop()
+            _PW = None
+
+
+# Requests the form automation never needs. Stylesheets are kept unless MDAC_BLOCK_CSS=1:
+# the flows rely on accordion/datepicker visibility, which depends on the site's CSS.
+# Matched by URL (extension or host) so the driver aborts them itself and every other
+# request goes straight to the network instead of round-tripping through Python.
+BLOCKED_EXTENSIONS = (
+    "png", "jpg", "jpeg", "gif", "webp", "svg", "ico", "bmp",   # image
+    "woff", "woff2", "ttf", "otf", "eot",                       # font
+    "mp4", "webm", "mp3", "ogg", "wav",                         # media
+) + (("css",) if BLOCK_STYLESHEETS else ())
+BLOCKED_HOSTS = (
+    "google-analytics.com",
+    "googletagmanager.com",
+    "doubleclick.net",
+    "googlesyndication.com",
+    "facebook.net",
+    "facebook.com/tr",
+    "hotjar.com",
+)
+_RE_BLOCKED_URL = re.compile(
+    r"\.(?:" + "|".join(BLOCKED_EXTENSIONS) + r")(?:[?#]|$)"
+    + r"|^https?://(?:[^/?#]*\.)?(?:" + "|".join(re.escape(h) for h in BLOCKED_HOSTS) + r")(?:[/?#:]|$)",
+    re.I,
+)
+
+
+async def _block_assets(route: Route) -> None:
+    await route.abort()
+
+
+# localStorage/sessionStorage/IndexedDB of the page's origin; about:blank etc. just no-op.
+CLEAR_STORAGE_JS = """
+async () => {
+  try { localStorage.clear(); sessionStorage.clear(); } catch (_) {}
+  try {
+    const dbs = indexedDB.databases ? await indexedDB.databases() : [];
+    await Promise.all(dbs.map(d => new Promise(r => {
+      const req = indexedDB.deleteDatabase(d.name);
+      req.onsuccess = req.onerror = req.onblocked = () => r();
+    })));
+  } catch (_) {}
+}
+"""
+
+
+def _context_kwargs() -> dict:
+    return {
         "viewport": {"width": 1280, "height": 900},
         "accept_downloads": True,
     }
 
+
+async def _prepare_context(context: BrowserContext, block_assets: bool) -> None:
+    """Per-context setup: date helper init script and optional asset blocking."""
+    await context.add_init_script(INSTALL_SET_DATE_JS)
+    if block_assets:
+        await context.route(_RE_BLOCKED_URL, _block_assets)
+
+
+class ContextPool:
+    """
+    Pre-warmed BrowserContexts shared across rows. A row rents one, opens its own Page,
+    and hands the context back; cookies/permissions/origin storage are wiped on release,
+    which is far cheaper than a newContext + close per row. Recording rows never use the
+    pool since the video dir is fixed per context.
+    """
+    def __init__(self, browser: Browser, size: int, block_assets: bool = BLOCK_ASSETS):
+        self.browser = browser
+        self.size = size
+        self.block_assets = block_assets
+        self._idle: asyncio.Queue[BrowserContext] = asyncio.Queue()
+        self._members: set[BrowserContext] = set()
+        self._lost = 0  # slots whose replacement failed; refilled on the next rent()
+
+    async def _new(self) -> BrowserContext:
+        ctx_kwargs = _context_kwargs()
+        if _warm_state is not None:
+            ctx_kwargs["storage_state"] = _warm_state
+        context = await self.browser.new_context(**ctx_kwargs)
+        await _prepare_context(context, self.block_assets)
+        self._members.add(context)
+        return context
+
+    async def start(self) -> "ContextPool":
+        for _ in range(self.size):
+            self._idle.put_nowait(await self._new())
+        log_ok(f"Context pool ready: {self.size} contexts")
+        return self
+
+    def owns(self, context: BrowserContext) -> bool:
+        return context in self._members
+
+    async def rent(self, timeout: float = POOL_RENT_TIMEOUT) -> Optional[BrowserContext]:
+        """Idle context, or None after `timeout`s so the caller can use a dedicated one."""
+        if self._idle.empty() and self._lost:
+            self._lost -= 1
+            try:
+                return await self._new()
+            except Exception as e:
+                self._lost += 1
+                log_err("Pooled context refill failed", e)
+        try:
+            return await asyncio.wait_for(self._idle.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def release(self, context: BrowserContext) -> None:
+        try:
+            # Wipe what the last traveler left in origin storage while pages still exist
+            for p in context.pages:
+                await p.evaluate(CLEAR_STORAGE_JS)
+            for p in context.pages:
+                await p.close()
+            await context.clear_cookies()
+            await context.clear_permissions()
+            # Pages closed earlier (popups, a row's own close) never got the wipe above
+            state = await context.storage_state()
+            if any(o.get("localStorage") for o in state.get("origins", [])):
+                raise RuntimeError("origin storage survived the reset")
+            if _warm_state and _warm_state.get("cookies"):
+                await context.add_cookies(_warm_state["cookies"])
+        except Exception as e:
+            log_err("Pooled context reset failed; replacing it", e)
+            self._members.discard(context)
+            try:
+                await context.close()
+            except Exception:
+                pass
+            try:
+                context = await self._new()
+            except Exception as e2:
+                self._lost += 1
+                log_err("Pooled context replacement failed; will retry on next rent", e2)
+                return
+        self._idle.put_nowait(context)
+
+    async def close(self) -> None:
+        for context in list(self._members):
+            try:
+                await context.close()
+            except Exception as e:
+                log_err("Pooled context close failed", e)
+        self._members.clear()
+
+
+async def open_context(
+    browser: Browser,
+    download_dir: Optional[Path] = None,
+    record_video_dir: Optional[Path] = None,
+    pool: Optional[ContextPool] = None,
+    block_assets: Optional[bool] = None,
+    storage_state: Optional[Union[dict, str, Path]] = None,
+) -> Tuple[BrowserContext, Page, ContextArtifacts]:
+    """
+    Create a fresh page on an already running browser. The context is rented from `pool`
+    when given, unless record_video_dir is set: then we create a dedicated context that
+    records video and store screenshots under <record_video_dir>/screens. Also starts
+    Playwright trace if enabled.
+    Dedicated contexts block images/fonts/trackers per MDAC_BLOCK_ASSETS unless recording
+    (block_assets=None), so debug videos show the real page; pooled contexts follow the
+    pool's setting. Dedicated contexts start from `storage_state` (a dict or a JSON path),
+    defaulting to the captured warm state.
+    """
+    if block_assets is None:
+        block_assets = BLOCK_ASSETS and record_video_dir is None
+    ctx_kwargs = _context_kwargs()
+
     screenshots_dir: Optional[Path] = None
     if record_video_dir is not None:
         try:
-            record_video_dir.mkdir(parents=True, exist_ok=True)
+            await _ensure_dir(record_video_dir)
             ctx_kwargs["record_video_dir"] = str(record_video_dir)
             ctx_kwargs["record_video_size"] = {"width": 1280, "height": 800}
             screenshots_dir = record_video_dir / "screens"
@@ -209,8 +622,23 @@ async def open_context(
         except Exception as e:
             log_err("Failed to prepare record_video_dir", e)
 
-    context = await browser.new_context(**ctx_kwargs)
-    log_ok("New browser context created")
+    context: Optional[BrowserContext] = None
+    if pool is not None and record_video_dir is None:
+        context = await pool.rent()
+        if context is not None:
+            log_ok("Browser context rented from pool")
+        else:
+            log_warn(f"No pooled context within {POOL_RENT_TIMEOUT:.0f}s; using a dedicated one")
+    if context is None:
+        if storage_state is None:
+            storage_state = _warm_state
+        if storage_state is not None:
+            ctx_kwargs["storage_state"] = os.fspath(storage_state) if isinstance(storage_state, Path) else storage_state
+        context = await browser.new_context(**ctx_kwargs)
+        log_ok("New browser context created")
+        await _prepare_context(context, block_assets)
+        if block_assets:
+            log_ok("Asset/tracker blocking enabled")
 
     if RECORD_TRACE and record_video_dir is not None:
         try:
@@ -230,7 +658,7 @@ async def open_context(
 
     if download_dir:
         try:
-            download_dir.mkdir(parents=True, exist_ok=True)
+            await _ensure_dir(download_dir)
             log_ok(f"Download dir ready: {download_dir}")
         except Exception as e:
             log_err("Failed to prepare download_dir", e)
@@ -242,14 +670,36 @@ async def open_context(
     )
 
 
+async def _close_context(context: BrowserContext, pool: Optional[ContextPool]) -> None:
+    # Pooled contexts go back to the pool; others are closed to flush video file to disk
+    if pool is not None and pool.owns(context):
+        await pool.release(context)
+        log_ok("Context released to pool")
+        return
+    try:
+        await context.close()
+        log_ok("Context closed")
+    except Exception as e:
+        log_err("Context close failed", e)
+
+
 async def _finalize_artifacts(
     context: BrowserContext,
     page: Page,
     artifacts: ContextArtifacts,
     record_dir: Optional[Path],
+    pool: Optional[ContextPool] = None,
 ) -> ContextArtifacts:
+    _log_net_summary(page)
+
+    # Not recording: no trace to stop and no video to resolve, just give the context back
+    if record_dir is None:
+        await _close_context(context, pool)
+        PRINT_BUFFER.drain()
+        return artifacts
+
     # Stop trace BEFORE closing context
-    if RECORD_TRACE and record_dir is not None:
+    if RECORD_TRACE:
         trace_zip = record_dir / "trace.zip"
         try:
             await context.tracing.stop(path=str(trace_zip))
@@ -258,12 +708,7 @@ async def _finalize_artifacts(
         except Exception as e:
             log_err("Trace stop failed", e)
 
-    # Close context to flush video file to disk
-    try:
-        await context.close()
-        log_ok("Context closed")
-    except Exception as e:
-        log_err("Context close failed", e)
+    await _close_context(context, pool)
 
     # Only after context closed, the video path becomes available
     try:
@@ -274,22 +719,67 @@ async def _finalize_artifacts(
     except Exception as e:
         log_err("Video path fetch failed", e)
 
+    PRINT_BUFFER.drain()
     return artifacts
 
 
 # ===== Generic actions (used by download flow only) =====
-async def navigate_safe(page: Page, url: str) -> None:
+async def wait_settled(page: Page, timeout: int = 5000) -> None:
+    """Wait for the network to go idle after a submit; returns early on fast responses."""
+    try:
+        await page.wait_for_load_state("networkidle", timeout=timeout)
+    except PlaywrightTimeoutError:
+        log_warn(f"Network not idle after {timeout}ms; continuing")
+
+
+@asynccontextmanager
+async def expect_submit(page: Page, timeout: int = 5000) -> AsyncIterator[None]:
+    """
+    Wrap a submit so the steps after it see the response. networkidle alone is already
+    true on the pre-submit page (Enter key, XHR submits), so first wait for a main-frame
+    navigation or an XHR/fetch POST answer, then for the network to settle.
+    """
+    fired: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def on_nav(frame):
+        if frame == page.main_frame and not fired.done():
+            fired.set_result("navigation")
+
+    def on_response(r):
+        req = r.request
+        if req.method != "GET" and req.resource_type in ("xhr", "fetch") and not fired.done():
+            fired.set_result("response")
+
+    page.on("framenavigated", on_nav)
+    page.on("response", on_response)
+    try:
+        yield
+        try:
+            log_ok(f"Submit answered by {await asyncio.wait_for(fired, timeout / 1000)}")
+        except asyncio.TimeoutError:
+            log_warn(f"No navigation/XHR answer within {timeout}ms of submit; continuing")
+    finally:
+        page.remove_listener("framenavigated", on_nav)
+        page.remove_listener("response", on_response)
+    await wait_settled(page, timeout)
+
+
+async def navigate_safe(page: Page, url: str) -> bool:
+    """Navigate to url, falling back to BASE. Returns True only if url itself loaded."""
     try:
         log(f"Navigate -> {url}")
         await page.goto(url, wait_until="domcontentloaded", timeout=60000)
         log_ok(f"Navigated: {page.url}")
+        return True
     except Exception as e:
         log_err(f"Navigate failed ({url}), retrying BASE", e)
+        forget_warm_state()  # a stale session may be what broke the landing page
         try:
             await page.goto(BASE, wait_until="domcontentloaded", timeout=60000)
             log_ok(f"Fallback navigate -> {BASE}")
         except Exception as e2:
             log_exc("Fallback navigate failed", e2)
+        return False
 
 
 async def click_if_exists(page: Page, text_regex: Pattern[str]) -> bool:
@@ -298,7 +788,7 @@ async def click_if_exists(page: Page, text_regex: Pattern[str]) -> bool:
     try:
         if await btn.count():
             log_ok(f"Button match found: /{text_regex.pattern}/")
-            await btn.first().click()
+            await btn.first.click()
             log_ok("Button clicked")
             return True
     except Exception as e:
@@ -308,7 +798,7 @@ async def click_if_exists(page: Page, text_regex: Pattern[str]) -> bool:
     try:
         if await link.count():
             log_ok(f"Link match found: /{text_regex.pattern}/")
-            await link.first().click()
+            await link.first.click()
             log_ok("Link clicked")
             return True
     except Exception as e:
@@ -319,21 +809,16 @@ async def click_if_exists(page: Page, text_regex: Pattern[str]) -> bool:
 
 
 # ===== Helpers tailored to the provided HTML =====
+_GENDER = {"m": "1", "f": "2"}             # MALE / FEMALE
+_MODE = {"a": "1", "l": "2", "s": "3"}     # AIR / LAND / SEA
+
+
 def _map_gender(g: Optional[str]) -> str:
-    if not g: return ""
-    g = g.strip().lower()
-    if g.startswith("m"): return "1"  # MALE
-    if g.startswith("f"): return "2"  # FEMALE
-    return ""
+    return _GENDER.get((g or "").strip().lower()[:1], "")
 
 
 def _map_mode(m: Optional[str]) -> str:
-    if not m: return ""
-    m = m.strip().lower()
-    if m.startswith("air"):  return "1"
-    if m.startswith("land"): return "2"
-    if m.startswith("sea"):  return "3"
-    return ""
+    return _MODE.get((m or "").strip().lower()[:1], "")
 
 
 def _extract_region_code(phone: Optional[str]) -> str:
@@ -343,13 +828,142 @@ def _extract_region_code(phone: Optional[str]) -> str:
     """
     if not phone:
         return ""
-    s = re.sub(r"[^\d+]", "", phone)
-    m = re.match(r"^\+?0{0,2}(\d{1,3})", s)
+    s = _RE_NONDIGIT.sub("", phone)
+    m = _RE_REGION.match(s)
     code = m.group(1) if m else ""
     log(f"Extracted region code from '{phone}': '{code}'")
     return code
 
 
+# Datepicker cascade (Bootstrap Datepicker / jQuery UI / Tempus / Inputmask / plain).
+# Takes {sel, val, dd, mm, yyyy}; returns {ok, mode, reason}.
+SET_DATE_JS = """
+async (cfg) => {
+  const { sel, val, dd, mm, yyyy } = cfg;
+  const el = document.querySelector(sel);
+  if (!el) return { ok:false, mode:'none', reason:'no element' };
+
+  const toDate = () => {
+    const y = parseInt(yyyy, 10), m = parseInt(mm, 10)-1, d = parseInt(dd, 10);
+    const dt = new Date(y, m, d);
+    // guard invalid
+    return isNaN(dt.getTime()) ? null : dt;
+  };
+  const dt = toDate();
+
+  const fire = (name) => {
+    try { el.dispatchEvent(new Event(name, { bubbles:true })); } catch (_) {}
+  };
+
+  // ---- Bootstrap Datepicker (eternicode) ----
+  try {
+    const $ = window.jQuery || window.$;
+    if ($ && $(el).datepicker) {
+      if (dt) {
+        $(el).datepicker('setDate', dt);
+      } else {
+        $(el).datepicker('setDate', val);
+      }
+      try { $(el).datepicker('update'); } catch(_) {}
+      try { $(el).trigger('changeDate'); } catch(_) {}
+      // Some implementations mirror to a hidden alt field via data-link-field
+      const linkId = el.getAttribute('data-link-field');
+      if (linkId) {
+        const alt = document.getElementById(linkId);
+        if (alt) alt.value = val;
+      }
+      el.value = val;     // ensure visible value matches
+      fire('input'); fire('change'); el.blur();
+      return { ok:true, mode:'bootstrap-datepicker' };
+    }
+  } catch (e) {
+    return { ok:false, mode:'bootstrap-datepicker', reason:String(e) };
+  }
+
+  // ---- jQuery UI Datepicker ----
+  try {
+    const $ = window.jQuery || window.$;
+    if ($ && $.datepicker && $.isFunction($.datepicker._selectDate)) {
+      if (dt) {
+        // _setDate formats automatically per widget options
+        $(el).datepicker('setDate', dt);
+      } else {
+        $(el).val(val);
+        $(el).datepicker('setDate', $(el).val());
+      }
+      try { $(el).datepicker('refresh'); } catch(_) {}
+      fire('input'); fire('change'); el.blur();
+      return { ok:true, mode:'jquery-ui' };
+    }
+  } catch (e) {
+    return { ok:false, mode:'jquery-ui', reason:String(e) };
+  }
+
+  // ---- Tempus Dominus / Bootstrap 4/5 datetimepicker (common APIs) ----
+  try {
+    const $ = window.jQuery || window.$;
+    if ($ && $(el).data && ($(el).data('DateTimePicker') || $(el).data('datetimepicker'))) {
+      const w = $(el).data('DateTimePicker') || $(el).data('datetimepicker');
+      if (w && w.date) {
+        if (dt) w.date(dt); else w.date(val);
+        fire('input'); fire('change'); el.blur();
+        return { ok:true, mode:'tempus' };
+      }
+    }
+  } catch (e) {
+    return { ok:false, mode:'tempus', reason:String(e) };
+  }
+
+  // ---- Inputmask-aware plain input ----
+  try {
+    // If Inputmask is attached, prefer its API so masks/validators run
+    if (el.inputmask && typeof el.inputmask.setValue === 'function') {
+      el.inputmask.setValue(val);
+      fire('input'); fire('change'); el.blur();
+      return { ok:true, mode:'inputmask' };
+    }
+  } catch (e) {
+    return { ok:false, mode:'inputmask', reason:String(e) };
+  }
+
+  // ---- Plain fallback ----
+  try {
+    el.removeAttribute('readonly');
+    el.value = val;
+    fire('input'); fire('change'); el.blur();
+    return { ok:true, mode:'plain' };
+  } catch (e) {
+    return { ok:false, mode:'plain', reason:String(e) };
+  }
+}
+"""
+
+# Installed once per context (add_init_script) so every page already has the cascade
+# and per-field evaluates only ship their arguments.
+INSTALL_SET_DATE_JS = "window.__mdacSetDate = " + SET_DATE_JS.strip() + ";"
+CALL_SET_DATE_JS = """
+async (cfg) => window.__mdacSetDate
+  ? window.__mdacSetDate(cfg)
+  : { ok:false, mode:'uninstalled', reason:'date helper not installed' }
+"""
+
+
+def _normalize_date(date_str: Optional[str]) -> Optional[Tuple[str, str, str]]:
+    """'YYYY-MM-DD' / 'DD-MM-YYYY' / 'DD/MM/YYYY' -> (dd, mm, yyyy), or None if unsupported."""
+    s = (date_str or "").strip()
+    m1 = _RE_DATE_YMD.match(s)
+    m2 = _RE_DATE_DMY_DASH.match(s)
+    if m1:
+        return m1.group(3), m1.group(2), m1.group(1)
+    if m2:
+        return m2.group(1), m2.group(2), m2.group(3)
+    # assume already DD/MM/YYYY (light validation)
+    mmddyyyy = _RE_DATE_DMY_SLASH.match(s)
+    if not mmddyyyy:
+        return None
+    return mmddyyyy.group(1), mmddyyyy.group(2), mmddyyyy.group(3)
+
+
 async def set_date_by_id(page: Page, input_id: str, date_str: str) -> None:
     """
     Robustly set a Bootstrap/jQuery datepicker (or plain readonly input).
@@ -359,146 +973,39 @@ async def set_date_by_id(page: Page, input_id: str, date_str: str) -> None:
     """
     sel = f"#{input_id}"
     # --- Normalize to DD/MM/YYYY ---
-    s = (date_str or "").strip()
-    m1 = re.match(r"^(\d{4})-(\d{2})-(\d{2})$", s)             # YYYY-MM-DD
-    m2 = re.match(r"^(\d{2})-(\d{2})-(\d{4})$", s)             # DD-MM-YYYY
-    if m1:
-        dd, mm, yyyy = m1.group(3), m1.group(2), m1.group(1)
-    elif m2:
-        dd, mm, yyyy = m2.group(1), m2.group(2), m2.group(3)
-    else:
-        # assume already DD/MM/YYYY (light validation)
-        mmddyyyy = re.match(r"^(\d{2})/(\d{2})/(\d{4})$", s)
-        if not mmddyyyy:
-            print(f"[MDAC] ❌ set_date_by_id('{input_id}'): unsupported format '{date_str}'", flush=True)
-            return
-        dd, mm, yyyy = mmddyyyy.group(1), mmddyyyy.group(2), mmddyyyy.group(3)
+    parts = _normalize_date(date_str)
+    if not parts:
+        log(f"❌ set_date_by_id('{input_id}'): unsupported format '{date_str}'")
+        return
+    dd, mm, yyyy = parts
     ddmmyyyy = f"{dd}/{mm}/{yyyy}"
 
-    print(f"[MDAC] 📅 set_date_by_id('{input_id}'): input='{date_str}' -> normalized='{ddmmyyyy}'", flush=True)
+    log(f"📅 set_date_by_id('{input_id}'): input='{date_str}' -> normalized='{ddmmyyyy}'")
 
     # Ensure element exists
     try:
         await page.wait_for_selector(sel, timeout=15000)
     except Exception as e:
-        print(f"[MDAC] ❌ date field not found: {sel} ({e})", flush=True)
+        log(f"❌ date field not found: {sel} ({e})")
         return
 
     # Try plugin path first (Bootstrap Datepicker / jQuery UI Datepicker / Tempus)
-    js = """
-    async (cfg) => {
-      const { sel, val, dd, mm, yyyy } = cfg;
-      const el = document.querySelector(sel);
-      if (!el) return { ok:false, mode:'none', reason:'no element' };
-
-      const toDate = () => {
-        const y = parseInt(yyyy, 10), m = parseInt(mm, 10)-1, d = parseInt(dd, 10);
-        const dt = new Date(y, m, d);
-        // guard invalid
-        return isNaN(dt.getTime()) ? null : dt;
-      };
-      const dt = toDate();
-
-      const fire = (name) => {
-        try { el.dispatchEvent(new Event(name, { bubbles:true })); } catch (_) {}
-      };
-
-      // ---- Bootstrap Datepicker (eternicode) ----
-      try {
-        const $ = window.jQuery || window.$;
-        if ($ && $(el).datepicker) {
-          if (dt) {
-            $(el).datepicker('setDate', dt);
-          } else {
-            $(el).datepicker('setDate', val);
-          }
-          try { $(el).datepicker('update'); } catch(_) {}
-          try { $(el).trigger('changeDate'); } catch(_) {}
-          // Some implementations mirror to a hidden alt field via data-link-field
-          const linkId = el.getAttribute('data-link-field');
-          if (linkId) {
-            const alt = document.getElementById(linkId);
-            if (alt) alt.value = val;
-          }
-          el.value = val;     // ensure visible value matches
-          fire('input'); fire('change'); el.blur();
-          return { ok:true, mode:'bootstrap-datepicker' };
-        }
-      } catch (e) {
-        return { ok:false, mode:'bootstrap-datepicker', reason:String(e) };
-      }
-
-      // ---- jQuery UI Datepicker ----
-      try {
-        const $ = window.jQuery || window.$;
-        if ($ && $.datepicker && $.isFunction($.datepicker._selectDate)) {
-          if (dt) {
-            // _setDate formats automatically per widget options
-            $(el).datepicker('setDate', dt);
-          } else {
-            $(el).val(val);
-            $(el).datepicker('setDate', $(el).val());
-          }
-          try { $(el).datepicker('refresh'); } catch(_) {}
-          fire('input'); fire('change'); el.blur();
-          return { ok:true, mode:'jquery-ui' };
-        }
-      } catch (e) {
-        return { ok:false, mode:'jquery-ui', reason:String(e) };
-      }
-
-      // ---- Tempus Dominus / Bootstrap 4/5 datetimepicker (common APIs) ----
-      try {
-        const $ = window.jQuery || window.$;
-        if ($ && $(el).data && ($(el).data('DateTimePicker') || $(el).data('datetimepicker'))) {
-          const w = $(el).data('DateTimePicker') || $(el).data('datetimepicker');
-          if (w && w.date) {
-            if (dt) w.date(dt); else w.date(val);
-            fire('input'); fire('change'); el.blur();
-            return { ok:true, mode:'tempus' };
-          }
-        }
-      } catch (e) {
-        return { ok:false, mode:'tempus', reason:String(e) };
-      }
-
-      // ---- Inputmask-aware plain input ----
-      try {
-        // If Inputmask is attached, prefer its API so masks/validators run
-        if (el.inputmask && typeof el.inputmask.setValue === 'function') {
-          el.inputmask.setValue(val);
-          fire('input'); fire('change'); el.blur();
-          return { ok:true, mode:'inputmask' };
-        }
-      } catch (e) {
-        return { ok:false, mode:'inputmask', reason:String(e) };
-      }
-
-      // ---- Plain fallback ----
-      try {
-        el.removeAttribute('readonly');
-        el.value = val;
-        fire('input'); fire('change'); el.blur();
-        return { ok:true, mode:'plain' };
-      } catch (e) {
-        return { ok:false, mode:'plain', reason:String(e) };
-      }
-    }
-    """
-
     try:
-        res = await page.evaluate(js, {"sel": sel, "val": ddmmyyyy, "dd": dd, "mm": mm, "yyyy": yyyy})
-        print(f"[MDAC] 📅 set_date_by_id('{input_id}'): mode={res.get('mode')} ok={res.get('ok')} reason={res.get('reason')}", flush=True)
+        cfg = {"sel": sel, "val": ddmmyyyy, "dd": dd, "mm": mm, "yyyy": yyyy}
+        res = await page.evaluate(CALL_SET_DATE_JS, cfg)
+        if res.get("mode") == "uninstalled":  # page predates the init script; ship the full cascade
+            res = await page.evaluate(SET_DATE_JS, cfg)
+        log(f"📅 set_date_by_id('{input_id}'): mode={res.get('mode')} ok={res.get('ok')} reason={res.get('reason')}")
     except Exception as e:
-        print(f"[MDAC] ❌ set_date_by_id('{input_id}') JS failed: {e}", flush=True)
+        log(f"❌ set_date_by_id('{input_id}') JS failed: {e}")
 
     # Verify what the field has now (after a brief tick so masks/formatters run)
     try:
         await page.wait_for_timeout(50)
         got = await page.eval_on_selector(sel, "el => el.value")
-        print(f"[MDAC] 📅 verify {input_id} -> '{got}'", flush=True)
+        log(f"📅 verify {input_id} -> '{got}'")
     except Exception as e:
-        print(f"[MDAC] ⚠️  verify failed for {input_id}: {e}", flush=True)
+        log(f"⚠️  verify failed for {input_id}: {e}")
 
 
 async def _select_if_value(page: Page, css: str, value: Optional[str]) -> None:
@@ -506,8 +1013,7 @@ async def _select_if_value(page: Page, css: str, value: Optional[str]) -> None:
         log_warn(f"_select_if_value: No value for {css}")
         return
     try:
-        await page.wait_for_selector(css, timeout=4000)
-        await page.select_option(css, str(value))
+        await page.select_option(css, str(value), timeout=4000)  # auto-waits for the element
         log_ok(f"Select {css} = {value}")
     except Exception as e:
         log_err(f"Select failed {css} = {value}", e)
@@ -518,25 +1024,158 @@ async def _fill_if_value(page: Page, css: str, value: Optional[str]) -> None:
         log_warn(f"_fill_if_value: No value for {css}")
         return
     try:
-        await page.wait_for_selector(css, timeout=4000)
-        await page.fill(css, str(value))
+        await page.fill(css, str(value), timeout=4000)  # auto-waits for the element
         log_ok(f"Fill {css} = '{value}'")
     except Exception as e:
         log_err(f"Fill failed {css} = '{value}'", e)
 
 
+# ===== Batched form fill =====
+# One evaluate() for the whole registration form instead of a CDP round-trip per field.
+# Steps run in order: {kind:'fill'|'select'|'date', sel, val, [dd, mm, yyyy]}.
+# Returns one {sel, kind, ok, mode?, reason?} per step.
+BATCH_FILL_JS = """
+async (payload) => {
+  const setDate = window.__mdacSetDate;
+  if (!setDate && payload.steps.some(s => s.kind === 'date')) throw new Error('date helper not installed');
+  const fire = (el, name) => {
+    try { el.dispatchEvent(new Event(name, { bubbles:true })); } catch (_) {}
+  };
+  const out = [];
+  for (const step of payload.steps) {
+    const res = { sel: step.sel, kind: step.kind, ok: false };
+    out.push(res);
+    try {
+      if (step.kind === 'date') {
+        Object.assign(res, await setDate(step));
+        continue;
+      }
+      const el = document.querySelector(step.sel);
+      if (!el) { res.reason = 'no element'; continue; }
+      if (step.kind === 'fill') {
+        el.value = step.val;
+        fire(el, 'input'); fire(el, 'change'); el.blur();
+        res.ok = true;
+      } else if (step.kind === 'select') {
+        // Match like Playwright's select_option: by value first, then by label
+        const opts = Array.from(el.options || []);
+        const opt = opts.find(o => o.value === step.val)
+                 || opts.find(o => o.label === step.val || o.text.trim() === step.val);
+        if (!opt) { res.reason = 'no matching option'; continue; }
+        el.value = opt.value;
+        fire(el, 'input'); fire(el, 'change');
+        res.ok = true;
+      }
+    } catch (e) {
+      res.reason = String(e);
+    }
+  }
+  return out;
+}
+"""
+
+# Dependent selects (city after state): poll in the page until options arrive, then pick
+# `val` (value, then label) or the first non-empty option. setTimeout, not rAF: rAF is
+# throttled in background/headless windows. Returns {ok, val?, reason?}.
+SELECT_WHEN_READY_JS = """
+async ({ sel, val, timeout }) => {
+  const start = performance.now();
+  while (performance.now() - start < timeout) {
+    const el = document.querySelector(sel);
+    if (el && el.options && el.options.length > 1) {
+      const opts = Array.from(el.options);
+      const opt = val
+        ? (opts.find(o => o.value === val) || opts.find(o => o.label === val || o.text.trim() === val))
+        : opts.find(o => o.value);
+      if (!opt) return { ok: false, reason: val ? 'no matching option' : 'no non-empty option' };
+      el.value = opt.value;
+      el.dispatchEvent(new Event('input', { bubbles:true }));
+      el.dispatchEvent(new Event('change', { bubbles:true }));
+      return { ok: true, val: opt.value };
+    }
+    await new Promise(r => setTimeout(r, 50));
+  }
+  return { ok: false, reason: 'options did not load within ' + timeout + 'ms' };
+}
+"""
+
+
+def _fill_step(css: str, value: Optional[str]) -> Optional[dict]:
+    if value is None:
+        log_warn(f"_fill_if_value: No value for {css}")
+        return None
+    return {"kind": "fill", "sel": css, "val": str(value)}
+
+
+def _select_step(css: str, value: Optional[str]) -> Optional[dict]:
+    if not value:
+        log_warn(f"_select_if_value: No value for {css}")
+        return None
+    return {"kind": "select", "sel": css, "val": str(value)}
+
+
+def _date_step(input_id: str, date_str: Optional[str]) -> Optional[dict]:
+    parts = _normalize_date(date_str)
+    if not parts:
+        log(f"❌ set_date_by_id('{input_id}'): unsupported format '{date_str}'")
+        return None
+    dd, mm, yyyy = parts
+    log(f"📅 set_date_by_id('{input_id}'): input='{date_str}' -> normalized='{dd}/{mm}/{yyyy}'")
+    return {"kind": "date", "sel": f"#{input_id}", "val": f"{dd}/{mm}/{yyyy}",
+            "dd": dd, "mm": mm, "yyyy": yyyy, "raw": date_str}
+
+
+async def _fill_steps_one_by_one(page: Page, steps: Sequence[dict]) -> None:
+    """Field-by-field fallback when the batched evaluate itself fails."""
+    for step in steps:
+        if step["kind"] == "fill":
+            await _fill_if_value(page, step["sel"], step["val"])
+        elif step["kind"] == "select":
+            await _select_if_value(page, step["sel"], step["val"])
+        else:
+            await set_date_by_id(page, step["sel"].lstrip("#"), step["raw"])
+
+
+async def _batch_fill(page: Page, steps: Sequence[Optional[dict]]) -> None:
+    steps = [st for st in steps if st]
+    try:
+        results = await page.evaluate(BATCH_FILL_JS, {"steps": steps})
+    except Exception as e:
+        log_err("Batch fill failed; falling back to field-by-field", e)
+        await _fill_steps_one_by_one(page, steps)
+        return
+    for step, res in zip(steps, results):
+        what = f"{step['kind'].capitalize()} {step['sel']} = '{step['val']}'"
+        if res.get("ok"):
+            log_ok(f"{what}" + (f" (mode={res['mode']})" if res.get("mode") else ""))
+        else:
+            log_err(f"{what} failed: {res.get('reason')}")
+
+
 # ===== High-level flows =====
+async def _move_download(download: Download, out: Path) -> None:
+    """Rename Playwright's temp file into place; copy via save_as only across filesystems."""
+    try:
+        os.replace(await download.path(), out)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        await download.save_as(str(out))
+
+
 async def register_one(page: Page, row: "RegisterRow", gate_token: Optional[str] = None, pause: bool = True) -> str:
     log("=== register_one: START ===")
+    r = row.model_dump()  # one plain dict instead of dozens of attribute lookups
     # Go straight to the registration page
-    await navigate_safe(page, f"{BASE}?registerMain")
+    if await navigate_safe(page, f"{BASE}?registerMain"):
+        await remember_warm_state(page.context)
     await _screenshot(page, "01_register_main")
 
     # Ensure accordion open
     try:
         if not await page.locator("#name").is_visible():
             log_warn("#name not visible; try opening 'Personal Information' accordion")
-            await page.get_by_role("link", name=re.compile(r"personal information", re.I)).click(timeout=4000)
+            await page.get_by_role("link", name=_RE_PERSONAL_INFO).click(timeout=4000)
         await page.locator("#passNo").click()
         log_ok("Personal Information section visible")
     except Exception as e:
@@ -544,99 +1183,76 @@ async def register_one(page: Page, row: "RegisterRow", gate_token: Optional[str]
 
     await _screenshot(page, "02_form_visible")
 
-    # ---- Personal Information ----
-    await _fill_if_value(page, "#name", getattr(row, "fullName", None))
-    await _fill_if_value(page, "#passNo", getattr(row, "passport", None))
-    await _fill_if_value(page, "#email", getattr(row, "email", None))
-    await _fill_if_value(page, "#confirmEmail", getattr(row, "email", None))
-
-    # DOB may not be #dob; try several selectors and normalize formats
-    await set_date_by_id(page, 'dob', getattr(row, "dateOfBirth", None))  # DD/MM/YYYY expected
-
-    # Nationality (3-letter code, e.g. 'BGD')
-    await _select_if_value(page, "#nationality", getattr(row, "nationality", None))
-
-    # Sex (1=MALE, 2=FEMALE)
-    mapped_sex = _map_gender(getattr(row, "gender", None))
-    log(f"Map gender '{getattr(row, 'gender', None)}' -> '{mapped_sex}'")
-    await _select_if_value(page, "#sex", mapped_sex)
-
-    # Passport Expiry (optional field in your model)
-    pass_exp = getattr(row, "passportExpiryDate", None)
-    await set_date_by_id(page, 'passExpDte', getattr(row, "passportExpiryDate", None))
-
-    # Country / Region code + Mobile
-    region_code = getattr(row, "regionCode", None) or _extract_region_code(getattr(row, "phone", None))
-    await _select_if_value(page, "#region", region_code)
-
-    mobile = getattr(row, "mobile", None)
-    if not mobile and getattr(row, "phone", None):
-        mobile = re.sub(r"^\+?\d{1,3}\s*[-]?\s*", "", getattr(row, "phone"))
-        log(f"Derived mobile from phone: '{getattr(row, 'phone')}' -> '{mobile}'")
-    await _fill_if_value(page, "#mobile", mobile)
+    # Derived values
+    mapped_sex = _map_gender(r.get("gender"))  # 1=MALE, 2=FEMALE
+    log(f"Map gender '{r.get('gender')}' -> '{mapped_sex}'")
+
+    region_code = r.get("regionCode") or _extract_region_code(r.get("phone"))
+
+    mobile = r.get("mobile")
+    if not mobile and r.get("phone"):
+        mobile = _RE_MOBILE_PREFIX.sub("", r["phone"])
+        log(f"Derived mobile from phone: '{r['phone']}' -> '{mobile}'")
+
+    mapped_mode = _map_mode(r.get("arrivalMode"))  # 1=AIR, 2=LAND, 3=SEA
+    log(f"Map mode '{r.get('arrivalMode')}' -> '{mapped_mode}'")
+
+    acc_type = r.get("accommodationStay") or "01"  # default to Hotel
+    addr1 = r.get("addressInMalaysia") or r.get("accommodationAddress1")
+    state_code = r.get("accommodationState") or r.get("stateCode") or "14"  # WP Kuala Lumpur
+
+    # ---- Personal Information: one round-trip while its section is open ----
+    # (each section is filled before the next opens, so the field-by-field fallback
+    # still finds visible elements if the accordion is exclusive)
+    await _batch_fill(page, [
+        _fill_step("#name", r.get("fullName")),
+        _fill_step("#passNo", r.get("passport")),
+        _fill_step("#email", r.get("email")),
+        _fill_step("#confirmEmail", r.get("email")),
+        _date_step("dob", r.get("dateOfBirth")),
+        _select_step("#nationality", r.get("nationality")),  # e.g. 'BGD'
+        _select_step("#sex", mapped_sex),
+        _date_step("passExpDte", r.get("passportExpiryDate")),
+        _select_step("#region", region_code),
+        _fill_step("#mobile", mobile),
+    ])
 
     # ---- Traveling Information ----
     try:
         if not await page.locator("#arrDt").is_visible():
             log_warn("#arrDt not visible; open 'Travel' accordion")
-            await page.get_by_role("link", name=re.compile(r"travel", re.I)).click(timeout=4000)
+            await page.get_by_role("link", name=_RE_TRAVEL).click(timeout=4000)
     except Exception as e:
         log_err("Opening Travel accordion failed (will proceed)", e)
 
-    await set_date_by_id(page, 'arrDt', getattr(row, "arrivalDate", None))  # must be within 3 days
-    await set_date_by_id(page, 'depDt', getattr(row, "departureDate", None))
-
-    await _fill_if_value(page, "#vesselNm", getattr(row, "flightNo", None))  # Flight / Vessel No.
-
-    # Mode of Travel (1=AIR, 2=LAND, 3=SEA)
-    mapped_mode = _map_mode(getattr(row, "arrivalMode", None))
-    log(f"Map mode '{getattr(row, 'arrivalMode', None)}' -> '{mapped_mode}'")
-    await _select_if_value(page, "#trvlMode", mapped_mode)
-
-    # Last port of embarkation before Malaysia (3-letter code, e.g. 'BGD')
-    await _select_if_value(page, "#embark", 'BGD - BANGLADESH')
-
-    # ---- Accommodation ----
-    acc_type = getattr(row, "accommodationStay", None) or "01"  # default to Hotel
-    await _select_if_value(page, "#accommodationStay", acc_type)
-
-    addr1 = getattr(row, "addressInMalaysia", None) or getattr(row, "accommodationAddress1", None)
-    await _fill_if_value(page, "#accommodationAddress1", addr1)
-    await _fill_if_value(page, "#accommodationAddress2", getattr(row, "accommodationAddress2", ""))
-
-    state_code = getattr(row, "accommodationState", None) or getattr(row, "stateCode", None) or "14"  # WP Kuala Lumpur
-    await _select_if_value(page, "#accommodationState", state_code)
+    # ---- Travel + Accommodation in one round-trip, in on-screen order ----
+    await _batch_fill(page, [
+        _date_step("arrDt", r.get("arrivalDate")),  # must be within 3 days
+        _date_step("depDt", r.get("departureDate")),
+        _fill_step("#vesselNm", r.get("flightNo")),  # Flight / Vessel No.
+        _select_step("#trvlMode", mapped_mode),
+        _select_step("#embark", "BGD - BANGLADESH"),  # last port of embarkation
+        _select_step("#accommodationStay", acc_type),
+        _fill_step("#accommodationAddress1", addr1),
+        _fill_step("#accommodationAddress2", r.get("accommodationAddress2", "")),
+        _select_step("#accommodationState", state_code),  # triggers the city list XHR
+    ])
 
     # Wait for city list to populate after state change
-    city_code = getattr(row, "accommodationCity", None) or getattr(row, "cityCode", None)
+    city_code = r.get("accommodationCity") or r.get("cityCode")
     try:
         log("Wait for city list to populate (#accommodationCity)")
-        await page.wait_for_function(
-            "() => { const sel = document.querySelector('#accommodationCity'); return sel && sel.options && sel.options.length > 1; }",
-            timeout=10000,
+        res = await page.evaluate(
+            SELECT_WHEN_READY_JS, {"sel": "#accommodationCity", "val": city_code or "", "timeout": 10000}
         )
-        log_ok("City list populated")
-        if city_code:
-            await page.select_option("#accommodationCity", city_code)
-            log_ok(f"City selected: {city_code}")
+        if res.get("ok"):
+            log_ok(f"City selected{'' if city_code else ' (first non-empty)'}: {res['val']}")
         else:
-            first_val = await page.evaluate("""
-                () => {
-                  const sel = document.querySelector('#accommodationCity');
-                  if (!sel) return '';
-                  for (const opt of sel.options) { if (opt.value) return opt.value; }
-                  return '';
-                }
-            """)
-            if first_val:
-                await page.select_option("#accommodationCity", first_val)
-                log_ok(f"City selected (first non-empty): {first_val}")
-            else:
-                log_warn("No non-empty city option found")
+            log_warn(f"City select failed: {res.get('reason')}")
     except Exception as e:
         log_err("City list populate/select failed", e)
 
-    postcode = getattr(row, "accommodationPostcode", None) or getattr(row, "postcode", None) or "50050"
+    postcode = r.get("accommodationPostcode") or r.get("postcode") or "50050"
     await _fill_if_value(page, "#accommodationPostcode", postcode)
 
     # Pause for manual CAPTCHA/OTP if requested
@@ -655,25 +1271,24 @@ async def register_one(page: Page, row: "RegisterRow", gate_token: Optional[str]
 
     # Submit
     log("Try submit form (#submit or Enter)")
-    try:
-        await page.click("#submit", timeout=5000)
-        log_ok("Submit button clicked")
-    except Exception as e:
-        log_warn(f"#submit click failed ({e}); try Enter")
+    async with expect_submit(page):
         try:
-            await page.keyboard.press("Enter")
-            log_ok("Enter pressed for submit")
-        except Exception as e2:
-            log_err("Submit via Enter failed", e2)
-
-    await page.wait_for_timeout(1500)
+            await page.click("#submit", timeout=5000)
+            log_ok("Submit button clicked")
+        except Exception as e:
+            log_warn(f"#submit click failed ({e}); try Enter")
+            try:
+                await page.keyboard.press("Enter")
+                log_ok("Enter pressed for submit")
+            except Exception as e2:
+                log_err("Submit via Enter failed", e2)
     await _screenshot(page, "03_after_submit")
 
     try:
-        body_txt = await page.inner_text("body")
+        # slice in the page so only the excerpt crosses CDP, not the whole form's text
+        summary = await page.evaluate("() => (document.body ? document.body.innerText : '').slice(0, 500)")
     except Exception:
-        body_txt = "submitted"
-    summary = body_txt[:500]
+        summary = "submitted"
     safe_excerpt = summary[:160].replace(os.linesep, " ")
     log(f"Register result (excerpt): {safe_excerpt}")
     log("=== register_one: END ===")
@@ -685,7 +1300,7 @@ async def download_one(page: Page, row: "PinRow", download_dir: Path) -> Optiona
     await navigate_safe(page, f"{BASE}?checkMain")
     await _screenshot(page, "10_check_main")
 
-    await click_if_exists(page, re.compile(r"(check registration|check|retrieve)", re.I))
+    await click_if_exists(page, _RE_CHECK)
 
     # The check/retrieve screen typically uses labeled inputs; keep generic helpers if IDs differ
     # Try common patterns first:
@@ -705,29 +1320,30 @@ async def download_one(page: Page, row: "PinRow", download_dir: Path) -> Optiona
     except Exception as e:
         log_err("Fill pin on check page failed", e)
 
-    if not await click_if_exists(page, re.compile(r"(submit|check|search)", re.I)):
-        try:
-            await page.keyboard.press("Enter")
-            log_ok("Pressed Enter on check page")
-        except Exception as e:
-            log_err("Enter press on check page failed", e)
-
-    await page.wait_for_timeout(1200)
+    async with expect_submit(page):
+        if not await click_if_exists(page, _RE_SUBMIT):
+            try:
+                await page.keyboard.press("Enter")
+                log_ok("Pressed Enter on check page")
+            except Exception as e:
+                log_err("Enter press on check page failed", e)
 
     # Direct download
     try:
-        btn = page.get_by_role("button", name=re.compile(r"(download|print)", re.I))
-        lnk = page.get_by_role("link", name=re.compile(r"(download|print)", re.I))
-        if await btn.count():
-            await btn.first().click()
-            log_ok("Clicked download/print button")
-        elif await lnk.count():
-            await lnk.first().click()
-            log_ok("Clicked download/print link")
-        download = await page.wait_for_event("download", timeout=25000)
+        btn = page.get_by_role("button", name=_RE_DOWNLOAD_BTN)
+        lnk = page.get_by_role("link", name=_RE_DOWNLOAD_BTN)
+        # Arm the download listener before clicking so a fast response can't slip past it
+        async with page.expect_download(timeout=25000) as dl_info:
+            if await btn.count():
+                await btn.first.click()
+                log_ok("Clicked download/print button")
+            elif await lnk.count():
+                await lnk.first.click()
+                log_ok("Clicked download/print link")
+        download = await dl_info.value
         suggested = download.suggested_filename
         out = download_dir / f"{row.passport}_{suggested}"
-        await download.save_as(str(out))
+        await _move_download(download, out)
         log_ok(f"PDF saved: {out}")
         log("=== download_one: END (direct) ===")
         return out
@@ -737,7 +1353,7 @@ async def download_one(page: Page, row: "PinRow", download_dir: Path) -> Optiona
     # Popup PDF
     try:
         async with page.expect_popup(timeout=25000) as pop_wait:
-            await click_if_exists(page, re.compile(r"(download|print|pdf)", re.I))
+            await click_if_exists(page, _RE_DOWNLOAD)
         popup = await pop_wait.value
         log_ok(f"Popup opened: {popup.url}")
         resp = await popup.wait_for_event(
@@ -746,7 +1362,7 @@ async def download_one(page: Page, row: "PinRow", download_dir: Path) -> Optiona
             timeout=25000,
         )
         content = await resp.body()
-        out = download_dir / f"{row.passport}_{int(asyncio.get_event_loop().time()*1000)}.pdf"
+        out = download_dir / f"{row.passport}_{monotonic_ns()}.pdf"
         out.write_bytes(content)
         await popup.close()
         log_ok(f"PDF saved (popup): {out}")
@@ -759,4 +1375,8 @@ async def download_one(page: Page, row: "PinRow", download_dir: Path) -> Optiona
 
 
 # expose finalize for main.py
-__all__ = ["open_context", "_finalize_artifacts", "register_one", "download_one", "GATE"]
+__all__ = [
+    "launch_browser", "get_browser", "shutdown_browser", "ContextPool", "open_context", "_finalize_artifacts",
+    "remember_warm_state", "forget_warm_state",
+    "register_one", "download_one", "GATE",
+]